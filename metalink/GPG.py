@@ -60,6 +60,11 @@ def translate():
     """
     Setup translation path
     """
+    locale_lang = locale.getlocale()[0]
+    # the C and POSIX locales have no catalog to look up
+    if locale_lang is None or locale_lang in ("C", "POSIX"):
+        return gettext.NullTranslations().gettext
+
     if __name__ == "__main__":
         try:
             base = os.path.basename(__file__)[:-3]
@@ -70,17 +75,10 @@ def translate():
     else:
         temp = __name__.split(".")
         base = temp[-1]
-        localedir = os.path.join("/".join(["%s" % k for k in temp[:-1]]), "locale")
+        localedir = os.path.join(*temp[:-1], "locale")
 
-    locale_lang = locale.getlocale()[0]
-    if locale_lang is None:
-        locale_lang = "LC_ALL"
-    t = gettext.translation(base, localedir, [locale_lang], None, "en")
-    try:
-        return t.ugettext
-    # python3
-    except:
-        return t.gettext
+    t = gettext.translation(base, localedir, [locale_lang], fallback=True)
+    return t.gettext
 
 
 _ = translate()
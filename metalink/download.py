@@ -62,18 +62,25 @@ import urllib.parse as urlparse
 import urllib.request as urllib2
 
 file = io.FileIO
+import atexit
 import base64
 import binascii
+import collections
+import concurrent.futures
 import copy
 import ftplib
+import functools
 import gettext
 
 import hashlib
+import heapq
 import locale
 import os
 import random
+import select
 import socket
 import ssl
+import struct
 import threading
 
 import time
@@ -117,11 +124,26 @@ UUID = None
 SEGMENTED = True
 LIMIT_PER_HOST = 1
 HOST_LIMIT = 5
+# Servers asked for the file size at the same time
+HEAD_LIMIT = 8
 MAX_REDIRECTS = 20
 CONNECT_RETRY_COUNT = 3
 
 MAX_CHUNKS = 256
 DEFAULT_CHUNK_SIZE = 262144
+# Bytes read from the network at a time by each segment
+SEGMENT_BUFFER_SIZE = 65536
+# Largest single read in urlretrieve()
+URLRETRIEVE_MAX_BLOCK = 4 * 1024 * 1024
+
+# Resume file header, magic and version then the block size as a little
+# endian unsigned 64 bit integer
+RESUME_HEADER = struct.Struct("<4sQ")
+RESUME_MAGIC = b"MLR\x01"
+# Flush the resume file to disk after every update
+RESUME_SYNC = False
+# Minimum seconds between resume file updates during segmented downloads
+RESUME_INTERVAL = 0.5
 
 LANG = []
 OS = None
@@ -139,6 +161,9 @@ if len(lang) == 5:
 PGP_KEY_DIR = "."
 PGP_KEY_EXTS = (".gpg", ".asc")
 PGP_KEY_STORE = None
+# imported keyring, rebuilt by get_gpg() when the key files change
+PGP_GPG = None
+PGP_GPG_STATE = None
 
 # Streaming server setings to use
 HOST = "localhost"
@@ -153,9 +178,27 @@ MIME_TYPE = "application/metalink+xml"
 
 DIGESTS = "md5,sha,sha-256,sha-384,sha-512"
 
+# Checksum types to verify, strongest first
+HASH_ALGORITHMS = ("sha512", "sha384", "sha256", "sha224", "sha1", "md5")
+# hashlib's named constructors, OpenSSL backed (SHA-NI where the CPU has it)
+HASH_CONSTRUCTORS = {
+    "sha512": hashlib.sha512,
+    "sha384": hashlib.sha384,
+    "sha256": hashlib.sha256,
+    "sha224": hashlib.sha224,
+    "sha1": hashlib.sha1,
+    "md5": hashlib.md5,
+}
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
 
 def translate():
     """Setup translation path."""
+    locale_lang = locale.getlocale()[0]
+    # the C and POSIX locales have no catalog to look up
+    if locale_lang is None or locale_lang in ("C", "POSIX"):
+        return gettext.NullTranslations().gettext
+
     if __name__ == "__main__":
         base = ""
         localedir = ""
@@ -169,13 +212,10 @@ def translate():
     else:
         temp = __name__.split(".")
         base = temp[-1]
-        localedir = os.path.join("/".join(["%s" % k for k in temp[:-1]]), "locale")
+        localedir = os.path.join(*temp[:-1], "locale")
 
     # print base, localedir
-    locale_lang = locale.getlocale()[0]
-    if locale_lang is None:
-        locale_lang = "LC_ALL"
-    t = gettext.translation(base, localedir, [locale_lang], None, "en")
+    t = gettext.translation(base, localedir, [locale_lang], fallback=True)
     return t.gettext
 
 
@@ -497,11 +537,17 @@ class Manager:
                 time.sleep(1)
             else:
                 if wait is not None:
-                    time.sleep(wait)
+                    self.sleep(wait)
                 result = self.cycle()
 
         return self.get_status()
 
+    def sleep(self, wait):
+        """
+        Pause between cycles
+        """
+        time.sleep(wait)
+
     def cycle(self):
         """
         return True to continue in loop, false to exit
@@ -671,16 +717,15 @@ class URLManager(Manager):
             return False
 
         block = self.temp.read(self.block_size)
-        self.data.acquire()
-        self.data.write(block)
-        self.data.release()
+        self.data.write_at(block, self.total)
         self.counter += 1
         self.total += len(block)
 
         self.resume.set_block_size(self.counter * self.block_size)
 
         if self.streamserver is not None:
-            self.streamserver.set_length(self.counter * self.block_size)
+            # only what is actually on disk, the last block may be short
+            self.streamserver.set_length(self.total)
 
         if self.status_handler is not None:
             self.status_handler(self.total, 1, self.size)
@@ -1080,17 +1125,19 @@ def urlretrieve(url, filename, reporthook=None, headers=None):
     if headers is None:
         headers = {}
 
-    block_size = 1024
-    i = 0
     counter = 0
     temp = urlopen(url, headers=headers)
     my_headers = temp.info()
 
     try:
         size = int(my_headers["Content-Length"])
-    except KeyError:
+    except (KeyError, TypeError):
         size = 0
 
+    # large reads keep the copy in C, still reporting progress about every 1%,
+    # capped so huge files neither buffer too much nor report too rarely
+    block_size = min(max(65536, size // 100), URLRETRIEVE_MAX_BLOCK)
+
     data = open(filename, "wb")
     block = True
 
@@ -1101,7 +1148,6 @@ def urlretrieve(url, filename, reporthook=None, headers=None):
     while block:
         block = temp.read(block_size)
         data.write(block)
-        i += block_size
         counter += 1
 
         resume.set_block_size(counter * block_size)
@@ -1120,129 +1166,295 @@ def urlretrieve(url, filename, reporthook=None, headers=None):
 class FileResume:
     """
     Manages the resume data file
+
+    Completed blocks are kept as a bitmap, one bit per block.  The file holds
+    a 4 byte magic, the block size as an 8 byte little endian integer and
+    then the bitmap.  The file stays open and only the changed bytes are
+    rewritten.  Files that fail to validate, such as the old text format,
+    are discarded and the download starts over.
     """
 
     def __init__(self, filename):
         self.size = 0
-        self.blocks = []
+        self.bits = bytearray()
         self.filename = filename
         self._read()
+        self._fd = os.open(
+            filename, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644
+        )
+        self._write()
+
+    @property
+    def blocks(self):
+        """
+        Sorted list of completed block ids
+        """
+        return [
+            byte * 8 + bit
+            for byte, value in enumerate(self.bits)
+            if value
+            for bit in range(8)
+            if value & (1 << bit)
+        ]
+
+    @property
+    def closed(self):
+        """
+        True once the block count file has been closed
+        """
+        return self._fd is None
+
+    def has_block(self, block_id):
+        """
+        Returns True if the block is in the list of completed
+        """
+        byte, bit = divmod(int(block_id), 8)
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << bit))
+
+    def _set_bit(self, block_id):
+        byte, bit = divmod(int(block_id), 8)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << bit
+
+    def _set_range(self, first, last):
+        """
+        Mark blocks first up to but not including last as completed
+        """
+        head = min(last, -(-first // 8) * 8)
+        tail = max(head, last // 8 * 8)
+        for block_id in range(first, head):
+            self._set_bit(block_id)
+        if tail > head:
+            # whole bytes in the middle are filled in one slice assignment
+            self._set_bit(tail - 1)
+            self.bits[head // 8 : tail // 8] = b"\xff" * ((tail - head) // 8)
+        for block_id in range(tail, last):
+            self._set_bit(block_id)
+
+    def _runs(self):
+        """
+        Yields (start, end) ranges of consecutive completed block ids
+        """
+        start = None
+        for byte, value in enumerate(self.bits):
+            if value == 0xFF:
+                if start is None:
+                    start = byte * 8
+                continue
+            if value == 0 and start is None:
+                continue
+            for bit in range(8):
+                if value & (1 << bit):
+                    if start is None:
+                        start = byte * 8 + bit
+                elif start is not None:
+                    yield start, byte * 8 + bit
+                    start = None
+        if start is not None:
+            yield start, len(self.bits) * 8
 
     def set_block_size(self, size):
         """
         Set the block size value without recomputing blocks
         """
         self.size = int(size)
-        self._write()
+        self._write_header()
 
     def update_block_size(self, size):
         """
         Recompute blocks based on new size
         """
+        size = int(size)
         if self.size == size:
             return
 
-        new_blocks = []
-        count = 0
-        total = 0
-        offset = None
-
-        for value in self.blocks:
-            value = int(value)
-            if value == count:
-                if offset is None:
-                    offset = count
-                total += self.size
-            elif offset is not None:
-                start = (offset * self.size) / size
-                new_blocks.extend(map(str, range(start, start + (total / size))))
-                total = 0
-                offset = None
-            count += 1
-
-        if offset is not None:
-            start = int((offset * self.size) / size)
-            # print(str, start, total, size)
-            # print(range(start, int(start + (total / size))))
-            new_blocks.extend(map(str, range(start, int(start + (total / size)))))
-
-        self.blocks = new_blocks
-        self.set_block_size(size)
+        old_runs = list(self._runs())
+        self.bits = bytearray()
+        if self.size > 0 and size > 0:
+            # remap each contiguous run of completed blocks, keeping only the
+            # new blocks that are entirely covered by it
+            for run_start, run_end in old_runs:
+                first = -(-run_start * self.size // size)
+                last = run_end * self.size // size
+                self._set_range(first, last)
+
+        self.size = size
+        self._write()
 
     def start_byte(self):
         """
         Returns byte to start at, all previous are OK
         """
-        if len(self.blocks) == 0:
-            return 0
-
-        count = 0
-        for value in self.blocks:
-            if int(value) != count:
-                return (count + 1) * self.size
+        # skip over the leading bytes where every block is complete
+        count = (len(self.bits) - len(self.bits.lstrip(b"\xff"))) * 8
+        while self.has_block(count):
             count += 1
-
-        return None
+        return count * self.size
 
     def add_block(self, block_id):
         """
         Add a block to list of completed
         """
-        if str(block_id) not in self.blocks:
-            self.blocks.append(str(block_id))
-        self._write()
+        self._set_bit(block_id)
+        byte = int(block_id) // 8
+        self._write_range(byte, byte + 1)
 
     def remove_block(self, block_id):
         """
         Remove a block from list of completed
         """
-        self.blocks.remove(str(block_id))
-        self._write()
+        byte, bit = divmod(int(block_id), 8)
+        if byte < len(self.bits):
+            self.bits[byte] &= ~(1 << bit) & 0xFF
+            self._write_range(byte, byte + 1)
 
     def clear_blocks(self):
         """
         Remove all blocks from completed list
         """
-        self.blocks = []
+        self.bits = bytearray()
         self._write()
 
     def extend_blocks(self, blocks):
         """
-        Replace the list of block ids
+        Add several blocks to list of completed
         """
+        first = None
+        last = None
         for block in blocks:
-            if str(block) not in self.blocks:
-                self.blocks.append(str(block))
-        self._write()
+            self._set_bit(block)
+            byte = int(block) // 8
+            if first is None or byte < first:
+                first = byte
+            if last is None or byte >= last:
+                last = byte + 1
+        if first is not None:
+            self._write_range(first, last)
 
     def _write(self):
-        filehandle = open(self.filename, "w")
-        filehandle.write("%s:" % str(self.size))
-        # for block_id in self.blocks:
-        # filehandle.write(str(block_id) + ",")
-        # print self.blocks
-        filehandle.write(",".join(self.blocks))
-        filehandle.close()
+        """
+        Rewrite the whole file
+        """
+        pwrite(
+            self._fd, RESUME_HEADER.pack(RESUME_MAGIC, self.size) + bytes(self.bits), 0
+        )
+        os.ftruncate(self._fd, RESUME_HEADER.size + len(self.bits))
+        if RESUME_SYNC:
+            fdatasync(self._fd)
+
+    def _write_header(self):
+        """
+        Rewrite only the block size header
+        """
+        pwrite(self._fd, RESUME_HEADER.pack(RESUME_MAGIC, self.size), 0)
+        if RESUME_SYNC:
+            fdatasync(self._fd)
+
+    def _write_range(self, first, last):
+        """
+        Rewrite only the bitmap bytes from first up to last
+        """
+        pwrite(self._fd, bytes(self.bits[first:last]), RESUME_HEADER.size + first)
+        if RESUME_SYNC:
+            fdatasync(self._fd)
 
     def _read(self):
+        self.bits = bytearray()
+        self.size = 0
         try:
-            filehandle = open(self.filename)
-            resume_str = filehandle.readline()
-            (size, blocks) = resume_str.split(":")
-            self.blocks = blocks.split(",")
-            self.size = int(size)
+            filehandle = open(self.filename, "rb")
+            data = filehandle.read()
             filehandle.close()
-        except (OSError, ValueError):
-            self.blocks = []
-            self.size = 0
+            magic, size = RESUME_HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return
+        bits = bytearray(data[RESUME_HEADER.size :])
+        if magic == RESUME_MAGIC and self._fits(size, bits):
+            self.size = size
+            self.bits = bits
+
+    def _fits(self, size, bits):
+        """
+        Returns True if every completed block starts inside the data file
+        """
+        bits = bits.rstrip(b"\x00")
+        if len(bits) == 0:
+            return True
+        if size == 0:
+            return False
+        last = (len(bits) - 1) * 8 + bits[-1].bit_length() - 1
+        datafile = self.filename
+        if datafile.endswith(".temp"):
+            datafile = datafile[: -len(".temp")]
+        try:
+            return last * size < os.path.getsize(datafile)
+        except OSError:
+            return False
+
+    def close(self):
+        """
+        Close the block count file, keeping it for a later resume
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
 
     def complete(self):
         """
         Download completed, remove block count file
         """
+        self.close()
         os.remove(self.filename)
 
 
+def pwrite(fd, data, offset):
+    """
+    Write data to a file descriptor at offset without moving the file position
+    Falls back to seek and write where os.pwrite() is missing (Windows)
+    """
+    data = memoryview(data)
+    while len(data) > 0:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        data = data[written:]
+        offset += written
+
+
+def pread(fd, size, offset):
+    """
+    Read up to size bytes from a file descriptor at offset without moving the
+    file position, less only at end of file
+    Falls back to seek and read where os.pread() is missing (Windows)
+    """
+    chunks = []
+    while size > 0:
+        if hasattr(os, "pread"):
+            data = os.pread(fd, size, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            data = os.read(fd, size)
+        if len(data) == 0:
+            break
+        chunks.append(data)
+        size -= len(data)
+        offset += len(data)
+    return b"".join(chunks)
+
+
+def fdatasync(fd):
+    """
+    Flush file data to disk, falls back to fsync where fdatasync is missing
+    """
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
 def verify_chunk_checksum(chunkstring, checksums=None):
     """
     Verify the checksum of a file
@@ -1252,25 +1464,30 @@ def verify_chunk_checksum(chunkstring, checksums=None):
     Returns True if no checksums are provided
     Returns False otherwise
     """
-    if checksums is None:
-        checksums = {}
+    hash_obj, expected = chunk_hasher(checksums)
 
-    hash_algorithms = ["sha512", "sha384", "sha256", "sha1", "md5"]
+    # No checksum provided, assume OK
+    if hash_obj is None:
+        return True
 
-    for algorithm in hash_algorithms:
-        try:
-            if checksums.get(algorithm):
-                hash_obj = hashlib.new(algorithm)
-                hash_obj.update(chunkstring)
-                if hash_obj.hexdigest() == checksums[algorithm].lower():
-                    return True
-                else:
-                    return False
-        except (KeyError, AttributeError):
-            pass
+    hash_obj.update(chunkstring)
+    return hash_obj.hexdigest() == expected
 
-    # No checksum provided, assume OK
-    return True
+
+def chunk_hasher(checksums=None):
+    """
+    Pick the strongest checksum to verify a chunk with
+    Returns a new hash object and the expected lowercase hex digest
+    Returns (None, None) if no checksums are provided
+    """
+    if checksums is None:
+        checksums = {}
+
+    for algorithm in HASH_ALGORITHMS:
+        expected = checksums.get(algorithm)
+        if expected:
+            return HASH_CONSTRUCTORS[algorithm](), expected.lower()
+    return None, None
 
 
 def verify_checksum(local_file, checksums=None):
@@ -1278,76 +1495,73 @@ def verify_checksum(local_file, checksums=None):
     Verify the checksum of a file
     First parameter, filename
     Second parameter, optional, expected dictionary of checksums
-    Returns True if first checksum provided is valid
+    Returns True if all checksums provided are valid
     Returns True if no checksums are provided
     Returns False otherwise
     """
     if checksums is None:
         checksums = {}
 
-    try:
-        return pgp_verify_sig(local_file, checksums["pgp"])
-    except (KeyError, AttributeError, ValueError, AssertionError):
-        pass
-    try:
-        checksums["sha512"]
-        if filehash(local_file, hashlib.sha512()) == checksums["sha512"].lower():
-            return True
-        else:
-            # print "\nERROR: sha512 checksum failed for %s." % os.path.basename(local_file)
-            return False
-    except (KeyError, AttributeError):
-        pass
-    try:
-        checksums["sha384"]
-        if filehash(local_file, hashlib.sha384()) == checksums["sha384"].lower():
-            return True
-        else:
-            # print "\nERROR: sha384 checksum failed for %s." % os.path.basename(local_file)
-            return False
-    except (KeyError, AttributeError):
-        pass
-    try:
-        checksums["sha256"]
-        if filehash(local_file, hashlib.sha256()) == checksums["sha256"].lower():
-            return True
-        else:
-            # print "\nERROR: sha256 checksum failed for %s." % os.path.basename(local_file)
-            return False
-    except (KeyError, AttributeError):
-        pass
-    try:
-        checksums["sha1"]
-        if filehash(local_file, hashlib.sha1()) == checksums["sha1"].lower():
-            return True
-        else:
-            # print "\nERROR: sha1 checksum failed for %s." % os.path.basename(local_file)
-            return False
-    except KeyError:
-        pass
-    try:
-        checksums["md5"]
-        if filehash(local_file, hashlib.md5()) == checksums["md5"].lower():
-            return True
-        else:
-            # print "\nERROR: md5 checksum failed for %s." % os.path.basename(local_file)
-            return False
-    except KeyError:
-        pass
+    if "pgp" in checksums:
+        try:
+            return pgp_verify_sig(local_file, checksums["pgp"])
+        except (AttributeError, ValueError, AssertionError):
+            pass
+
+    # only the algorithms actually present are hashed, no lookups can miss
+    hashers = {
+        algorithm: HASH_CONSTRUCTORS[algorithm]()
+        for algorithm in HASH_ALGORITHMS
+        if checksums.get(algorithm)
+    }
 
     # No checksum provided, assume OK
-    return True
+    if len(hashers) == 0:
+        return True
 
+    if not filehashes(local_file, hashers.values()):
+        return False
 
-def pgp_verify_sig(filename, sig):
-    gpg = GPG.GPGSubprocess(keyring=PGP_KEY_STORE)
+    for algorithm, hash_obj in hashers.items():
+        if hash_obj.hexdigest() != checksums[algorithm].lower():
+            return False
+    return True
 
+
+def pgp_key_files():
+    """
+    Returns a sorted list of (path, mtime) for the key files in PGP_KEY_DIR
+    """
+    keys = []
     for root, dirs, files in os.walk(PGP_KEY_DIR):
         for thisfile in files:
             if thisfile[-4:] in PGP_KEY_EXTS:
-                gpg.import_key(open(thisfile).read())
+                path = os.path.join(root, thisfile)
+                keys.append((path, os.path.getmtime(path)))
+    keys.sort()
+    return keys
+
+
+def get_gpg():
+    """
+    Returns a GPG instance with every key in PGP_KEY_DIR imported
+    The instance is reused until the key files or the keyring change
+    """
+    global PGP_GPG, PGP_GPG_STATE
+
+    state = (PGP_KEY_STORE, pgp_key_files())
+    if PGP_GPG is None or state != PGP_GPG_STATE:
+        gpg = GPG.GPGSubprocess(keyring=PGP_KEY_STORE)
+        for path, mtime in state[1]:
+            with open(path) as keyfile:
+                gpg.import_key(keyfile.read())
+        PGP_GPG = gpg
+        PGP_GPG_STATE = state
+    return PGP_GPG
+
 
-    sign = gpg.verify_file_detached(filename, sig)
+def pgp_verify_sig(filename, sig):
+    sign = get_gpg().verify_file_detached(filename, sig)
 
     print("\n-----" + _("BEGIN PGP SIGNATURE INFORMATION") + "-----")
     if sign.error is not None:
@@ -1394,19 +1608,18 @@ def is_local(name):
     return False
 
 
+@functools.lru_cache(maxsize=4096)
 def get_transport(url):
     """
     Gets transport type.  This is more accurate than the urlparse module which
-    just does a split on colon.
+    just does a split on colon.  Results are cached, the same few urls are
+    checked over and over during a segmented download.
     First parameter, url
     Returns the transport type
     """
-    url = str(url)
-    result = url.split("://", 1)
-    if len(result) == 1:
-        transport = ""
-    else:
-        transport = result[0]
+    transport, separator, rest = str(url).partition("://")
+    if separator == "":
+        return ""
     return transport
 
 
@@ -1420,16 +1633,60 @@ def filehash(thisfile, filesha):
     except:
         return ""
 
-    chunksize = 1024 * 1024
-    data = filehandle.read(chunksize)
-    while data != b"":
-        filesha.update(data)
-        data = filehandle.read(chunksize)
+    with filehandle:
+        # Python 3.11+, C read loop that releases the GIL while hashing
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(filehandle, lambda: filesha).hexdigest()
+
+        buffer = bytearray(1024 * 1024)
+        view = memoryview(buffer)
+        size = filehandle.readinto(buffer)
+        while size:
+            filesha.update(view[:size])
+            size = filehandle.readinto(buffer)
 
-    filehandle.close()
     return filesha.hexdigest()
 
 
+def filehashes(thisfile, hash_objs):
+    """
+    Feed every hash object from a single read pass over the file, hashlib
+    releases the GIL on large buffers so the updates run concurrently
+    First parameter, filename
+    Second parameter, list of hashlib objects to update
+    Returns True if the file was read, False otherwise
+    """
+    hash_objs = list(hash_objs)
+    try:
+        filehandle = open(thisfile, "rb")
+    except:
+        return False
+
+    executor = None
+    if len(hash_objs) > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(hash_objs))
+
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    try:
+        size = filehandle.readinto(buffer)
+        while size:
+            data = view[:size]
+            if executor is None:
+                hash_objs[0].update(data)
+            else:
+                concurrent.futures.wait(
+                    [executor.submit(hash_obj.update, data) for hash_obj in hash_objs]
+                )
+            size = filehandle.readinto(buffer)
+    finally:
+        filehandle.close()
+        if executor is not None:
+            executor.shutdown()
+
+    return True
+
+
 def path_join(first, second):
     """
     A function that is called to join two paths, can be URLs or filesystem paths
@@ -1450,13 +1707,16 @@ def path_join(first, second):
 
 
 def start_sort(urldict):
-    urls = copy.deepcopy(urldict)
+    """
+    Returns list of urls, those in COUNTRY first, then by preference
+    """
     local_urls = {}
-    if COUNTRY is not None:
-        for url in list(urls):
-            if COUNTRY.lower() == urls[url].location.lower():
-                local_urls[url] = urls[url]
-                urls.pop(url)
+    urls = {}
+    for url, resource in urldict.items():
+        if COUNTRY is not None and COUNTRY.lower() == resource.location.lower():
+            local_urls[url] = resource
+        else:
+            urls[url] = resource
 
     new_urls = sort_prefs(local_urls)
     new_urls.extend(sort_prefs(urls))
@@ -1482,6 +1742,12 @@ def sort_prefs(mydict):
 
 
 class ThreadSafeFile(file):
+    """
+    File that several threads read and write at absolute offsets.  Uses
+    positioned I/O so no lock is needed, except where os.pread/os.pwrite are
+    missing (Windows) and a seek has to go with each read or write.
+    """
+
     def __init__(self, *args):
         file.__init__(self, *args)
         self.lock = threading.Lock()
@@ -1492,6 +1758,27 @@ class ThreadSafeFile(file):
     def release(self):
         return self.lock.release()
 
+    def write_at(self, data, offset):
+        """
+        Write all of data starting at offset
+        raise ValueError if the file is closed
+        """
+        if hasattr(os, "pwrite"):
+            pwrite(self.fileno(), data, offset)
+        else:
+            with self.lock:
+                pwrite(self.fileno(), data, offset)
+
+    def read_at(self, size, offset):
+        """
+        Read up to size bytes starting at offset, less only at end of file
+        raise ValueError if the file is closed
+        """
+        if hasattr(os, "pread"):
+            return pread(self.fileno(), size, offset)
+        with self.lock:
+            return pread(self.fileno(), size, offset)
+
 
 class Segment_Manager(Manager):
     def __init__(self, metalinkfile, headers={}):
@@ -1499,7 +1786,22 @@ class Segment_Manager(Manager):
 
         self.headers = headers.copy()
         self.sockets = []
+        # idle sockets, queued by the hosts themselves when a segment ends
+        self.idle = collections.deque()
+        # number of sockets open to each url
+        self.host_load = {}
+        self.url_heap = None
+        self.url_rank = {}
+        # set by segments as they finish to start the next cycle early
+        self.wakeup = threading.Event()
         self.chunks = []
+        # segment bookkeeping, kept up to date by collect_segments()
+        self.running = {}
+        self.free = []
+        self.failed = []
+        self.completed = set()
+        self.done_bytes = 0
+        self.prechecked = set()
         self.limit_per_host = LIMIT_PER_HOST
         self.host_limit = HOST_LIMIT
         # self.size = 0
@@ -1522,6 +1824,9 @@ class Segment_Manager(Manager):
             self.f = ThreadSafeFile(self.localfile, "wb+")
 
         self.resume = FileResume(self.localfile + ".temp")
+        # completed chunks already recorded in the resume file
+        self.persisted = set()
+        self.last_persist = 0
 
         self.streamserver = None
         if PORT is not None:
@@ -1544,68 +1849,48 @@ class Segment_Manager(Manager):
 
     def get_size(self):
         """
-        Take a best guess at size based on first 3 matching servers
+        Take a best guess at size based on first 3 matching servers, the
+        servers are queried concurrently.  Requests still in flight once 3
+        sizes are known are left to finish in the background.  The worker
+        threads are joined at interpreter exit, so a stalled server delays
+        exit until it answers or its socket times out
 
         raise socket.error e.g. "Operation timed out"
         """
-        i = 0
         sizes = []
         checksums = []
-        urls = list(self.urls)
+        urls = [url for url in self.urls if get_transport(url) in ("http", "ftp")]
 
-        while i < len(urls) and (len(sizes) < 3):
-            url = urls[i]
-            protocol = get_transport(url)
-            if protocol == "http":
-                status = httplib.MOVED_PERMANENTLY
-                count = 0
-                size = None
-                checksum_dict = {}
-                while (
-                    status == httplib.MOVED_PERMANENTLY or status == httplib.FOUND
-                ) and count < MAX_REDIRECTS:
-                    http = Http_Host(url)
-                    if http.conn is not None:
-                        try:
-                            headers = {"Want-Digest": DIGESTS}
-                            headers.update(self.headers)
-                            http.conn.request("HEAD", url, headers=headers)
-                            response = http.conn.getresponse()
-                            status = response.status
-                            url = response.getheader("Location")
-                            size = response.getheader("content-length")
-                            checksum_dict = digest_parse(
-                                response.getheader("Digest", None)
-                            )
-                        except:
-                            pass
-                        http.close()
-                    count += 1
-
-                if (status == httplib.OK) and (size is not None):
-                    sizes.append(size)
-                    if len(checksum_dict) > 0:
-                        checksums.append(checksum_dict)
-
-            elif protocol == "ftp":
-                ftp = Ftp_Host(url)
-
-                try:
-                    size = ftp.conn.size(url)
-                except ftplib.error_perm:
-                    size = None
-
-                if size is not None:
-                    sizes.append(size)
-
-            i += 1
+        if len(urls) > 0:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(HEAD_LIMIT, len(urls))
+            )
+            futures = [executor.submit(self.head_size, url) for url in urls]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    size, checksum_dict = future.result()
+                    if size is not None:
+                        sizes.append(size)
+                        if len(checksum_dict) > 0:
+                            checksums.append(checksum_dict)
+                    if len(sizes) >= 3:
+                        break
+            finally:
+                # queued lookups are dropped, ones already sent run on until
+                # they answer or time out
+                if sys.version_info >= (3, 9):
+                    executor.shutdown(wait=False, cancel_futures=True)
+                else:
+                    for future in futures:
+                        future.cancel()
+                    executor.shutdown(wait=False)
 
         if len(self.checksums) == 0 and len(checksums) > 0:
             if len(checksums) == 1:
                 self.checksums = checksums[0]
-            if checksums.count(checksums[0]) >= 2:
+            elif checksums.count(checksums[0]) >= 2:
                 self.checksums = checksums[0]
-            if checksums.count(checksums[1]) >= 2:
+            elif checksums.count(checksums[1]) >= 2:
                 self.checksums = checksums[1]
 
         if len(sizes) == 0:
@@ -1619,6 +1904,57 @@ class Segment_Manager(Manager):
 
         return None
 
+    def head_size(self, url):
+        """
+        Query one server for the file size, following redirects
+        Returns tuple of size (None if unknown) and dictionary of checksums
+
+        raise socket.error e.g. "Operation timed out"
+        """
+        size = None
+        checksum_dict = {}
+        protocol = get_transport(url)
+        if protocol == "http":
+            status = httplib.MOVED_PERMANENTLY
+            count = 0
+            while (
+                status == httplib.MOVED_PERMANENTLY or status == httplib.FOUND
+            ) and count < MAX_REDIRECTS:
+                http = Http_Host(url)
+                if http.conn is not None:
+                    try:
+                        headers = {"Want-Digest": DIGESTS}
+                        headers.update(self.headers)
+                        http.conn.request("HEAD", url, headers=headers)
+                        response = http.conn.getresponse()
+                        response.read()
+                        http.release()
+                        status = response.status
+                        url = response.getheader("Location")
+                        size = response.getheader("content-length")
+                        checksum_dict = digest_parse(response.getheader("Digest", None))
+                    except:
+                        http.close()
+                count += 1
+
+            if status != httplib.OK:
+                return None, {}
+
+        elif protocol == "ftp":
+            # an unreachable mirror must not stop the others from answering
+            try:
+                ftp = Ftp_Host(url)
+            except ftplib.all_errors:
+                return None, {}
+
+            try:
+                size = ftp.conn.size(url)
+            except ftplib.all_errors:
+                size = None
+            ftp.close()
+
+        return size, checksum_dict
+
     def filter_urls(self):
         new_urls = {}
         for item in list(self.urls.keys()):
@@ -1645,9 +1981,18 @@ class Segment_Manager(Manager):
             self.chunk_size = self.size / MAX_CHUNKS
             # print "Set chunk size to %s." % self.chunk_size
         self.resume.update_block_size(self.chunk_size)
+        self.persisted = set(self.resume.blocks)
 
         return Manager.run(self, wait)
 
+    def sleep(self, wait):
+        """
+        Wait up to wait seconds for the next cycle, returns early as soon as a
+        segment finishes or another host can be put to work
+        """
+        self.wakeup.wait(wait)
+        self.wakeup.clear()
+
     def cycle(self):
         """
         Runs one cycle
@@ -1671,7 +2016,7 @@ class Segment_Manager(Manager):
                 return False
 
             self.update()
-            self.resume.extend_blocks(self.chunk_list())
+            self.save_resume()
 
             if _bytes >= self.size and self.active_count() == 0:
                 self.resume.complete()
@@ -1710,70 +2055,117 @@ class Segment_Manager(Manager):
             return
 
         index = self.get_chunk_index()
-        if index is not None:
-            start = index * self.chunk_size
-            end = start + self.chunk_size
-            if end > self.size:
-                end = self.size
-
-            if _next.protocol == "http" or _next.protocol == "https":
-                segment = Http_Host_Segment(
-                    _next, start, end, self.size, self.get_chunksum(index), self.headers
-                )
-                segment.set_cancel_callback(self.cancel_handler)
-                self.chunks[index] = segment
-                self.segment_init(index)
-            if _next.protocol == "ftp":
-                # print "allocated to:", index, next.url
-                segment = Ftp_Host_Segment(
-                    _next, start, end, self.size, self.get_chunksum(index)
-                )
-                segment.set_cancel_callback(self.cancel_handler)
-                self.chunks[index] = segment
-                self.segment_init(index)
+        if index is None:
+            # every chunk is taken, keep the host for one that fails later
+            self.idle.appendleft(_next)
+            return
+
+        # more hosts may be free, run the next cycle right away
+        self.wakeup.set()
+        start = index * self.chunk_size
+        end = start + self.chunk_size
+        if end > self.size:
+            end = self.size
+
+        if _next.protocol == "http" or _next.protocol == "https":
+            segment = Http_Host_Segment(
+                _next, start, end, self.size, self.get_chunksum(index), self.headers
+            )
+            segment.set_cancel_callback(self.cancel_handler)
+            segment.set_done_callback(self.wakeup.set)
+            self.set_chunk(index, segment)
+            self.segment_init(index)
+        if _next.protocol == "ftp":
+            # print "allocated to:", index, next.url
+            segment = Ftp_Host_Segment(
+                _next, start, end, self.size, self.get_chunksum(index)
+            )
+            segment.set_cancel_callback(self.cancel_handler)
+            segment.set_done_callback(self.wakeup.set)
+            self.set_chunk(index, segment)
+            self.segment_init(index)
 
     def segment_init(self, index):
         segment = self.chunks[index]
-        if str(index) in self.resume.blocks:
+        # the data on disk only needs checking the first time a chunk is tried
+        segment.precheck = index not in self.prechecked
+        self.prechecked.add(index)
+        if self.resume.has_block(index):
             segment.end()
             if segment.error is None:
                 segment.bytes = segment.byte_count
             else:
                 self.resume.remove_block(index)
+                self.persisted.discard(index)
         else:
             segment.start()
 
-    def get_chunk_index(self):
-        i = -1
-        for i in range(len(self.chunks)):
-            if self.chunks[i] is None or self.chunks[i].error is not None:
-                return i
-            # weed out dead segments that have temp errors and reassign
-            if not self.chunks[i].isAlive() and self.chunks[i].bytes == 0:
-                return i
-        i += 1
-
-        if (i * self.chunk_size) < self.size:
+    def set_chunk(self, index, segment):
+        """
+        Assign the chunk returned by get_chunk_index() to segment
+        """
+        if len(self.free) > 0 and self.free[0] == index:
+            heapq.heappop(self.free)
+        else:
             self.chunks.append(None)
-            return i
+        self.chunks[index] = segment
+        self.running[index] = segment
 
-        return None
+    def collect_segments(self):
+        """
+        Move finished segments out of the running set and update the totals
+        Only running segments are checked, not the whole chunk list
+        """
+        for index, segment in list(self.running.items()):
+            if segment.is_alive():
+                continue
+            del self.running[index]
+            if segment.error is not None:
+                self.failed.append(segment)
+                heapq.heappush(self.free, index)
+            elif segment.bytes == 0:
+                # dead segment with a temp error, reassign
+                heapq.heappush(self.free, index)
+            else:
+                self.done_bytes += segment.bytes
+                if segment.bytes == self.chunk_size:
+                    self.completed.add(index)
 
-    def gen_count_array(self):
-        temp = {}
-        for item in self.sockets:
-            try:
-                temp[item.url] += 1
-            except KeyError:
-                temp[item.url] = 1
-        return temp
+    def get_chunk_index(self):
+        """
+        Returns the lowest chunk index free to download, None if all are taken
+        """
+        self.collect_segments()
+        if len(self.free) > 0:
+            return self.free[0]
+
+        index = len(self.chunks)
+        if (index * self.chunk_size) < self.size:
+            return index
+
+        return None
 
     def active_count(self):
-        count = 0
-        for item in self.chunks:
-            if item.isAlive():
-                count += 1
-        return count
+        self.collect_segments()
+        return len(self.running)
+
+    def build_url_heap(self):
+        """
+        Rebuild the scheduling heap of (socket count, preference rank, url)
+        """
+        self.url_rank = {}
+        self.url_heap = []
+        for rank, url in enumerate(start_sort(self.urls)):
+            self.url_rank[url] = rank
+            self.url_heap.append((self.host_load.get(url, 0), rank, url))
+        heapq.heapify(self.url_heap)
+
+    def add_socket(self, host):
+        host.set_idle_queue(self.idle)
+        self.sockets.append(host)
+        load = self.host_load.get(host.url, 0) + 1
+        self.host_load[host.url] = load
+        heapq.heappush(self.url_heap, (load, self.url_rank[host.url], host.url))
 
     def next_url(self):
         """returns next socket to use or None if none available"""
@@ -1783,113 +2175,129 @@ class Segment_Manager(Manager):
             len(self.sockets) >= (self.limit_per_host * len(self.urls))
         ):
             # We can't create any more sockets, but we can see what's available
-            # print "existing sockets"
-            for item in self.sockets:
-                # print item.active, item.url
-                if not item.get_active():
+            while len(self.idle) > 0:
+                item = self.idle.popleft()
+                if not item.get_active() and item.url in self.urls:
                     return item
             return None
 
-        count = self.gen_count_array()
-        # randomly start with a url index
-        # urls = list(self.urls)
-        # number = int(random.random() * len(self.urls))
-        urls = start_sort(self.urls)
-        number = 0
-
-        countvar = 1
-        while countvar <= len(self.urls):
-            try:
-                temp_count = count[urls[number]]
-            except KeyError:
-                temp_count = 0
+        if self.url_heap is None:
+            self.build_url_heap()
+
+        # least loaded url first, ties go to the preferred url
+        host = None
+        skipped = []
+        while host is None and len(self.url_heap) > 0:
+            entry = heapq.heappop(self.url_heap)
+            load, rank, url = entry
+            # stale entry, the url was removed or has gained sockets since
+            if url not in self.urls or self.host_load.get(url, 0) != load:
+                continue
             # check against limits
-            if ((temp_count == 0) and (len(count) < self.host_limit)) or (
-                0 < temp_count < self.limit_per_host
+            if load >= self.limit_per_host:
+                skipped.append(entry)
+                break
+            if load == 0 and len(self.host_load) >= self.host_limit:
+                skipped.append(entry)
+                continue
+
+            # check protocol type here, unsupported urls leave the heap
+            protocol = get_transport(url)
+            if (not url.endswith(".torrent")) and (
+                protocol == "http" or protocol == "https"
             ):
-                # check protocol type here
-                protocol = get_transport(urls[number])
-                if (not urls[number].endswith(".torrent")) and (
-                    protocol == "http" or protocol == "https"
+                host = Http_Host(url, self.f)
+            elif protocol == "ftp":
+                try:
+                    host = Ftp_Host(url, self.f)
+                except (
+                    socket.gaierror,
+                    socket.timeout,
+                    ftplib.error_temp,
+                    ftplib.error_perm,
+                    OSError,
                 ):
-                    host = Http_Host(urls[number], self.f)
-                    self.sockets.append(host)
-                    return host
-                if protocol == "ftp":
-                    try:
-                        host = Ftp_Host(urls[number], self.f)
-                    except (
-                        socket.gaierror,
-                        socket.timeout,
-                        ftplib.error_temp,
-                        ftplib.error_perm,
-                        OSError,
-                    ):
-                        self.urls.pop(urls[number])
-                        return None
-                    self.sockets.append(host)
-                    return host
+                    self.urls.pop(url)
+                    break
 
-            number = (number + 1) % len(self.urls)
-            countvar += 1
+        for entry in skipped:
+            heapq.heappush(self.url_heap, entry)
 
-        return None
+        if host is not None:
+            self.add_socket(host)
+        return host
 
     def remove_errors(self):
-        for item in self.chunks:
-            if item is not None and item.error is not None:
+        self.collect_segments()
+        failed = self.failed
+        self.failed = []
+        for item in failed:
+            if item.error is not None:
                 if (
                     item.error == httplib.MOVED_PERMANENTLY
                     or item.error == httplib.FOUND
                 ):
                     try:
-                        new_item = copy.deepcopy(self.urls[item.url])
+                        new_item = copy.copy(self.urls[item.url])
                         new_item.url = item.location
                         self.urls[item.location] = new_item
+                        self.url_heap = None
                     except KeyError:
                         pass
                     self.filter_urls()
 
                 try:
                     self.urls.pop(item.url)
+                    self.host_load.pop(item.url, None)
                 except KeyError:
                     pass
 
-        for socket_item in self.sockets:
-            if socket_item.url not in self.urls.keys():
-                self.sockets.remove(socket_item)
+        self.sockets = [
+            socket_item for socket_item in self.sockets if socket_item.url in self.urls
+        ]
 
         return
 
     def byte_total(self):
-        total = 0
-        count = 0
-        for item in self.chunks:
-            try:
-                if item.error is None:
-                    total += item.bytes
-            except AttributeError:
-                pass
-            count += 1
+        self.collect_segments()
+        total = self.done_bytes
+        for item in self.running.values():
+            if item.error is None:
+                total += item.bytes
         return total
 
     def chunk_list(self):
-        chunks = []
-        for i in range(len(self.chunks)):
-            # print i, self.chunks[i].bytes
-            try:
-                if self.chunks[i].bytes == self.chunk_size:
-                    chunks.append(i)
-            except AttributeError:
-                pass
-        # print chunks
-        return chunks
+        self.collect_segments()
+        return sorted(self.completed)
+
+    def save_resume(self, force=False):
+        """
+        Record newly completed chunks in the resume file, at most once every
+        RESUME_INTERVAL seconds unless forced
+        """
+        now = time.monotonic()
+        if not force and now - self.last_persist < RESUME_INTERVAL:
+            return
+        self.last_persist = now
+
+        self.collect_segments()
+        new_blocks = self.completed - self.persisted
+        if len(new_blocks) > 0:
+            self.resume.extend_blocks(sorted(new_blocks))
+            self.persisted |= new_blocks
 
     def close_handler(self):
         if PORT is None:
             self.f.close()
         for host in self.sockets:
-            host.close()
+            # hosts with no segment running have read their last response
+            if host.get_active():
+                host.close()
+            else:
+                host.release()
+        if not self.resume.closed:
+            self.save_resume(True)
+        self.resume.close()
 
         self.update()
 
@@ -1922,6 +2330,8 @@ class Host_Base:
 
         self.url = url
         self.mem = memmap
+        self.idle_queue = None
+        self.buffer = None
 
         transport = get_transport(self.url)
         self.protocol = transport
@@ -1929,8 +2339,31 @@ class Host_Base:
     def import_stats(self, segment):
         pass
 
+    def get_buffer(self):
+        """
+        Returns a memoryview of this host's receive buffer, allocated once and
+        reused by every segment the host downloads
+        """
+        if self.buffer is None:
+            self.buffer = memoryview(bytearray(SEGMENT_BUFFER_SIZE))
+        return self.buffer
+
+    def set_idle_queue(self, queue):
+        """
+        Queue to append this host to whenever it becomes inactive
+        """
+        self.idle_queue = queue
+
     def set_active(self, value):
         self.active = value
+        if not value and self.idle_queue is not None:
+            self.idle_queue.append(self)
+
+    def release(self):
+        """
+        Done with this host, by default just closes the connection
+        """
+        self.close()
 
     def get_active(self):
         return self.active
@@ -1963,7 +2396,8 @@ class Ftp_Host(Host_Base):
                 port = ftplib.FTP_PORT
 
             self.conn = proxy.FTP()
-            self.conn.connect(url_parts[1], port)
+            # netloc may also hold the port and credentials
+            self.conn.connect(url_parts.hostname, port)
             try:
                 self.conn.login(username, password)
             except:
@@ -1990,11 +2424,81 @@ class Ftp_Host(Host_Base):
         self.connect()
 
 
+class ConnectionPool:
+    """
+    Keeps idle HTTP and HTTPS connections for reuse, up to LIMIT_PER_HOST for
+    each protocol, host and port
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, protocol, host, port):
+        """
+        Returns an idle connection, or a new one if none is left
+        raise httplib.InvalidURL
+        """
+        key = (protocol, host, port)
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while len(conns) > 0:
+                conn = conns.pop()
+                if not self.dropped(conn):
+                    return conn
+                conn.close()
+
+        if protocol == "https":
+            return proxy.HTTPSConnection(host, port)
+        return proxy.HTTPConnection(host, port)
+
+    def put(self, protocol, host, port, conn):
+        """
+        Keep a connection for reuse, any response on it must be fully read
+        """
+        if conn.sock is not None:
+            with self.lock:
+                conns = self.idle.setdefault((protocol, host, port), [])
+                if len(conns) < LIMIT_PER_HOST:
+                    conns.append(conn)
+                    return
+        conn.close()
+
+    def dropped(self, conn):
+        """
+        Returns True if the server closed the connection while it was idle
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return True
+        # an idle connection is only readable when the server hung up
+        return len(readable) > 0
+
+    def clear(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+HTTP_POOL = ConnectionPool()
+# idle keep-alive connections are closed when the interpreter exits
+atexit.register(HTTP_POOL.clear)
+
+
 class Http_Host(Host_Base):
     def __init__(self, url, memmap=None):
         Host_Base.__init__(self, url, memmap)
 
         urlparts = urlparse.urlsplit(self.url)
+        self.host = urlparts.hostname
         if self.url.endswith(".torrent"):
             self.error = _("unsupported protocol")
             return
@@ -2005,11 +2509,6 @@ class Http_Host(Host_Base):
                 port = httplib.HTTP_PORT
             if port is None:
                 port = httplib.HTTP_PORT
-            try:
-                self.conn = proxy.HTTPConnection(urlparts[1], port)
-            except httplib.InvalidURL:
-                self.error = _("invalid url")
-                return
         elif self.protocol == "https":
             try:
                 port = urlparts.port
@@ -2017,19 +2516,29 @@ class Http_Host(Host_Base):
                 port = httplib.HTTPS_PORT
             if port is None:
                 port = httplib.HTTPS_PORT
-            try:
-                self.conn = proxy.HTTPSConnection(urlparts[1], port)
-            except httplib.InvalidURL:
-                self.error = _("invalid url")
-                return
         else:
             self.error = _("unsupported protocol")
             return
 
+        self.port = port
+        try:
+            self.conn = HTTP_POOL.get(self.protocol, self.host, self.port)
+        except httplib.InvalidURL:
+            self.error = _("invalid url")
+            return
+
     def close(self):
         if self.conn is not None:
             self.conn.close()
 
+    def release(self):
+        """
+        Hand the connection back to the pool, only once any response is read
+        """
+        if self.conn is not None:
+            HTTP_POOL.put(self.protocol, self.host, self.port, self.conn)
+            self.conn = None
+
 
 class Host_Segment:
     """
@@ -2053,18 +2562,26 @@ class Host_Segment:
         self.url = host.url
         self.mem = host.mem
         self.checksums = checksums
+        # chunk hash, updated as data is written
+        self.hasher, self.digest = chunk_hasher(checksums)
+        # check the data already on disk before downloading
+        self.precheck = True
         self.error = None
         self.ttime = 0
         self.response = None
         self.bytes = 0
-        self.buffer = b""
+        self.pending = 0
         self.temp = ""
         self.cancel_handler = None
+        self.done_handler = None
         self.headers = headers.copy()
 
     def set_cancel_callback(self, handler):
         self.cancel_handler = handler
 
+    def set_done_callback(self, handler):
+        self.done_handler = handler
+
     def check_cancel(self):
         if self.cancel_handler is None:
             return False
@@ -2078,23 +2595,77 @@ class Host_Segment:
         if self.check_cancel():
             return False
 
+        if self.hasher is None:
+            return True
+
+        # the whole range was hashed on its way to disk
+        if self.bytes == self.byte_count:
+            return self.hasher.hexdigest() == self.digest
+
         try:
-            self.mem.acquire()
-            self.mem.seek(self.byte_start, 0)
-            chunk_str = self.mem.read(self.byte_count)
-            self.mem.release()
-        except ValueError:
+            chunk_str = self.mem.read_at(self.byte_count, self.byte_start)
+        except (ValueError, OSError):
+            return False
+
+        # the file does not reach the end of this chunk yet
+        if len(chunk_str) < self.byte_count:
             return False
 
         return verify_chunk_checksum(chunk_str, self.checksums)
 
+    def get_view(self):
+        """
+        Returns the free part of the host buffer to read into, flushing
+        it first if it is already full
+        """
+        view = self.host.get_buffer()
+        if self.pending == len(view) and not self.flush():
+            return None
+        end = min(len(view), self.pending + self.byte_count - self.bytes)
+        return view[self.pending : end]
+
+    def add_pending(self, size):
+        """
+        Record size bytes read into the buffer, writing them out once the
+        buffer is full or the segment is complete
+        Returns False if the write failed
+        """
+        self.pending += size
+        self.bytes += size
+        if self.pending == len(self.host.get_buffer()) or self.bytes >= self.byte_count:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """
+        Write buffered data out to the file with a single call
+        Returns False if the write failed
+        """
+        if self.pending == 0:
+            return True
+        view = self.host.get_buffer()[: self.pending]
+        offset = self.byte_start + self.bytes - self.pending
+        self.pending = 0
+        if self.hasher is not None:
+            self.hasher.update(view)
+        try:
+            self.mem.write_at(view, offset)
+        except (ValueError, OSError):
+            self.error = _("bad file handle")
+            return False
+        return True
+
     def close(self):
+        self.flush()
         if self.error is not None:
             self.host.close()
 
         self.host.set_active(False)
+        if self.done_handler is not None:
+            self.done_handler()
 
     def end(self):
+        self.flush()
         if self.error is None and not self.checksum():
             self.error = _("Chunk checksum failed")
         self.close()
@@ -2107,7 +2678,7 @@ class Ftp_Host_Segment(threading.Thread, Host_Segment):
 
     def run(self):
         # Finish early if checksum is OK
-        if self.checksum() and len(self.checksums) > 0:
+        if self.precheck and len(self.checksums) > 0 and self.checksum():
             self.bytes += self.byte_count
             self.close()
             return
@@ -2123,14 +2694,20 @@ class Ftp_Host_Segment(threading.Thread, Host_Segment):
         size = None
         retry = True
         count = 0
+        command = "RETR " + urlparts.path
         while retry and count < CONNECT_RETRY_COUNT:
             retry = False
             try:
                 (self.response, size) = self.host.conn.ntransfercmd(
-                    "RETR " + urlparts.path, self.byte_start, self.byte_end
+                    command, self.byte_start, self.byte_end
                 )
             except ftplib.error_perm as error:
-                self.error = error.message
+                self.error = str(error)
+                self.close()
+                return
+            except ftplib.error_temp as error:
+                # this is not an error condition, most likely transfer TCP connection was closed
+                self.temp = str(error)
                 self.close()
                 return
             except (socket.gaierror, socket.timeout) as error:
@@ -2148,17 +2725,13 @@ class Ftp_Host_Segment(threading.Thread, Host_Segment):
             except OSError:
                 try:
                     self.host.reconnect()
-                except:
-                    pass
+                except (OSError, EOFError, ftplib.Error) as error:
+                    # the host is gone, retrying will not help
+                    self.error = str(error)
+                    self.close()
+                    return
                 retry = True
                 count += 1
-            except ftplib.error_temp as error:
-                # this is not an error condition, most likely transfer TCP connection was closed
-                # count += 1
-                # self.error = "error temp", error.message
-                self.temp = error.message
-                self.close()
-                return
             except ftplib.error_reply:
                 # this is likely just an extra chatty FTP server, ignore for now
                 pass
@@ -2171,14 +2744,15 @@ class Ftp_Host_Segment(threading.Thread, Host_Segment):
         if size is not None:
             if self.filesize != size:
                 self.error = _("bad file size")
+                self.close()
                 return
 
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         while True:
             if self.readable():
                 self.handle_read()
-                self.ttime += time.time() - self.start_time
             else:
+                self.ttime = time.monotonic() - self.start_time
                 self.end()
                 return
 
@@ -2191,75 +2765,63 @@ class Ftp_Host_Segment(threading.Thread, Host_Segment):
         return True
 
     def handle_read(self):
+        view = self.get_view()
+        if view is None:
+            self.response = None
+            return
+
         try:
-            data = self.response.recv(1024)
+            size = self.response.recv_into(view)
         except socket.timeout:
             self.error = _("read timeout")
             self.response = None
             return
-
-        if len(data) == 0:
+        except httplib.IncompleteRead:
+            self.error = _("incomplete read")
+            self.response = None
+            return
+        except OSError:
+            self.error = _("socket error")
+            self.response = None
             return
 
-        self.buffer += data
-        # print len(self.buffer), self.byte_count
-        if len(self.buffer) >= self.byte_count:
-            # When using a HTTP proxy there is no shutdown() call
-            try:
-                self.response.shutdown(socket.SHUT_RDWR)
-            except AttributeError:
-                pass
-
-            temp_buffer = self.buffer[: self.byte_count]
-            self.buffer = b""
+        if size == 0:
+            # data connection closed before the whole range arrived
+            self.error = _("incomplete read")
+            self.end_transfer()
+            return
 
-            self.bytes += len(temp_buffer)
+        # short reads collect in the buffer and are written out together
+        if not self.add_pending(size):
+            self.response = None
+            return
 
-            try:
-                self.mem.acquire()
-                self.mem.seek(self.byte_start, 0)
-                self.mem.write(temp_buffer)
-                self.mem.flush()
-                self.mem.release()
-            except ValueError:
-                self.error = _("bad file handle")
+        if self.bytes >= self.byte_count:
+            self.end_transfer()
 
-            self.response = None
+    def end_transfer(self):
+        """
+        Close the data connection and read the reply ending the transfer, so
+        the control connection is ready for the next segment
+        """
+        response = self.response
+        self.response = None
+        # When using a HTTP proxy there is no shutdown() call
+        try:
+            response.shutdown(socket.SHUT_RDWR)
+        except AttributeError:
+            return
+        except OSError:
+            pass
+        response.close()
 
-        # this method writes directly to file on each data grab, not working for some reason
-
-
-##        if (self.bytes + len(data)) >= self.byte_count:
-##            # When using a HTTP proxy there is no shutdown() call
-##            try:
-##                self.response.shutdown(socket.SHUT_RDWR)
-##            except AttributeError:
-##                pass
-##
-##            index = self.byte_count - (self.bytes + len(data))
-##
-##            writedata = data[:index]
-##
-##            self.mem.acquire()
-##            self.mem.seek(self.byte_start + self.bytes, 0)
-##            self.mem.write(writedata)
-##            self.mem.flush()
-##
-##            self.mem.release()
-##
-##            self.response = None
-##        else:
-##            writedata = data
-##
-##            lock = threading.Lock()
-##            lock.acquire()
-##
-##            self.mem.seek(self.byte_start + self.bytes, 0)
-##            self.mem.write(writedata)
-##
-##            lock.release()
-##
-##        self.bytes += len(writedata)
+        try:
+            self.host.conn.voidresp()
+        except (ftplib.error_temp, ftplib.error_perm):
+            # 426, the rest of the file was cut off
+            pass
+        except (OSError, EOFError):
+            self.error = _("socket error")
 
 
 class Http_Host_Segment(threading.Thread, Host_Segment):
@@ -2270,7 +2832,7 @@ class Http_Host_Segment(threading.Thread, Host_Segment):
     def run(self):
         # try:
         # Finish early if checksum is OK
-        if self.checksum() and len(self.checksums) > 0:
+        if self.precheck and len(self.checksums) > 0 and self.checksum():
             self.bytes += self.byte_count
             self.close()
             return
@@ -2290,12 +2852,12 @@ class Http_Host_Segment(threading.Thread, Host_Segment):
             self.close()
             return
 
-        self.start_time = time.time()
+        self.start_time = time.monotonic()
         while True:
             if self.readable():
                 self.handle_read()
-                self.ttime += time.time() - self.start_time
             else:
+                self.ttime = time.monotonic() - self.start_time
                 self.end()
                 return
 
@@ -2335,8 +2897,17 @@ class Http_Host_Segment(threading.Thread, Host_Segment):
             return False
 
     def handle_read(self):
+        if self.bytes == 0 and not self.check_headers():
+            self.response = None
+            return
+
+        view = self.get_view()
+        if view is None:
+            self.response = None
+            return
+
         try:
-            data = self.response.read()
+            size = self.response.readinto(view)
         except socket.timeout:
             self.error = _("timeout")
             self.response = None
@@ -2353,20 +2924,39 @@ class Http_Host_Segment(threading.Thread, Host_Segment):
             self.response = None
             return
 
-        if len(data) == 0:
+        if size == 0:
+            # connection closed before the whole range arrived
+            self.error = _("incomplete read")
+            self.response = None
             return
 
-        range_str = self.response.getheader("Content-Range")
-        request_size = int(range_str.split("/")[1])
-
-        if request_size != self.filesize:
-            self.error = _("bad file size")
+        # short reads collect in the buffer and are written out together
+        if not self.add_pending(size):
             self.response = None
             return
 
-        # Check digest headers against expected
+        # print self.bytes, self.byte_count
+        if self.bytes >= self.byte_count:
+            self.response = None
+
+    def check_headers(self):
+        """
+        Check the response headers before reading the body
+        Returns False if the body should not be used
+        """
+        # "bytes start-end/size", only the size is needed
+        range_str = self.response.getheader("Content-Range", "")
+        request_size = range_str.rpartition("/")[2]
+
+        if not request_size.isdigit() or int(request_size) != self.filesize:
+            self.error = _("bad file size")
+            return False
+
+        # Check digest headers against expected, only parsed if it names one
         digest = self.response.getheader("Digest", None)
-        if digest is not None:
+        if digest is not None and any(
+            hashtype in digest for hashtype in self.checksums
+        ):
             digest_sums = digest_parse(digest)
             # check digest here, skip if missing, return if mismatch
             for hashtype in self.checksums.keys():
@@ -2376,27 +2966,9 @@ class Http_Host_Segment(threading.Thread, Host_Segment):
                     continue
 
                 if self.checksums[hashtype] != digest_sums[hashtype]:
-                    return
-
-        body = data
-        size = len(body)
-
-        # write out body to file
-        try:
-            self.mem.acquire()
-            self.mem.seek(self.byte_start + self.bytes, 0)
-            self.mem.write(body)
-            self.mem.flush()
-            self.mem.release()
-        except ValueError:
-            self.error = _("bad file handle")
-            self.response = None
-            return
+                    return False
 
-        self.bytes += size
-        # print self.bytes, self.byte_count
-        if self.bytes >= self.byte_count:
-            self.response = None
+        return True
 
 
 class StreamRequest(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -2407,24 +2979,23 @@ class StreamRequest(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
 
         start = 0
-        while True:
+        while self.server.run:
             if self.server.fileobj is not None and (self.server.length - start) > 0:
                 try:
-                    self.server.fileobj.acquire()
-                    loc = self.server.fileobj.tell()
-                    self.server.fileobj.seek(start, 0)
                     size = self.server.length - start
 
-                    data = self.server.fileobj.read(size)
+                    data = self.server.fileobj.read_at(size, start)
                     if len(data) > 0:
                         self.wfile.write(data)
-
-                    self.server.fileobj.seek(loc, 0)
-                    self.server.fileobj.release()
-                    start += len(data)
+                        start += len(data)
+                        continue
                 except ValueError:
                     break
-            time.sleep(0.1)
+                # advertised but not on disk yet, wait for the length to grow
+                # or poll again shortly instead of spinning on empty reads
+                self.server.wait_length(self.server.length, 0.1)
+                continue
+            self.server.wait_length(start)
 
 
 class StreamServer(BaseHTTPServer.HTTPServer):
@@ -2432,6 +3003,8 @@ class StreamServer(BaseHTTPServer.HTTPServer):
         BaseHTTPServer.HTTPServer.__init__(self, *args)
         self.fileobj = None
         self.length = 0
+        # notified when the length grows or the server stops
+        self.length_cond = threading.Condition()
 
     # based on: http://code.activestate.com/recipes/425210/
     def server_bind(self):
@@ -2451,7 +3024,9 @@ class StreamServer(BaseHTTPServer.HTTPServer):
                 pass
 
     def stop(self):
-        self.run = False
+        with self.length_cond:
+            self.run = False
+            self.length_cond.notify_all()
 
     def serve(self):
         try:
@@ -2466,7 +3041,19 @@ class StreamServer(BaseHTTPServer.HTTPServer):
         self.fileobj = fileobj
 
     def set_length(self, length):
-        self.length = int(length)
+        with self.length_cond:
+            self.length = int(length)
+            self.length_cond.notify_all()
+
+    def wait_length(self, start, timeout=1.0):
+        """
+        Block until more than start bytes are available to stream, the
+        server stops or timeout seconds pass
+        """
+        with self.length_cond:
+            self.length_cond.wait_for(
+                lambda: self.length > start or not self.run, timeout
+            )
 
 
 # if __name__=="__main__":
@@ -2246,13 +2246,18 @@ def filehash(thisfile, filesha):
     except:
         return ""
 
-    chunksize = 1024 * 1024
-    data = filehandle.read(chunksize)
-    while data != "":
-        filesha.update(data)
-        data = filehandle.read(chunksize)
+    with filehandle:
+        # Python 3.11+, C read loop that releases the GIL while hashing
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(filehandle, lambda: filesha).hexdigest()
+
+        buffer = bytearray(1024 * 1024)
+        view = memoryview(buffer)
+        size = filehandle.readinto(buffer)
+        while size:
+            filesha.update(view[:size])
+            size = filehandle.readinto(buffer)
 
-    filehandle.close()
     return filesha.hexdigest()
 
 
@@ -0,0 +1,325 @@
+import hashlib
+import http.client
+import http.server
+import threading
+import time
+
+import pytest
+
+from metalink import download, metalink
+
+DATA = b"pymetalink" * 100000
+
+
+def write_sample(tmp_path):
+    sample = tmp_path / "sample.bin"
+    sample.write_bytes(DATA)
+    return str(sample)
+
+
+def test_verify_checksum_without_checksums(tmp_path):
+    assert download.verify_checksum(write_sample(tmp_path), {})
+
+
+def test_verify_checksum_all_algorithms(tmp_path):
+    checksums = {
+        algorithm: hashlib.new(algorithm, DATA).hexdigest().upper()
+        for algorithm in download.HASH_ALGORITHMS
+    }
+    assert download.verify_checksum(write_sample(tmp_path), checksums)
+
+
+def test_verify_checksum_mismatch(tmp_path):
+    checksums = {
+        "sha256": hashlib.sha256(DATA).hexdigest(),
+        "md5": "0" * 32,
+    }
+    assert not download.verify_checksum(write_sample(tmp_path), checksums)
+
+
+def test_verify_checksum_missing_file(tmp_path):
+    checksums = {"sha1": hashlib.sha1(DATA).hexdigest()}
+    assert not download.verify_checksum(str(tmp_path / "missing.bin"), checksums)
+
+
+def test_file_resume_round_trip(tmp_path):
+    write_sample(tmp_path)
+    filename = str(tmp_path / "sample.bin.temp")
+    resume = download.FileResume(filename)
+    resume.set_block_size(1024)
+    resume.extend_blocks([0, 1, 2, 9])
+    resume.remove_block(1)
+
+    resume = download.FileResume(filename)
+    assert resume.size == 1024
+    assert resume.blocks == [0, 2, 9]
+    assert resume.has_block(9)
+    assert not resume.has_block(1)
+    assert not resume.has_block(100)
+    assert resume.start_byte() == 1024
+
+
+@pytest.mark.parametrize("with_data", [True, False])
+def test_file_resume_discards_invalid(tmp_path, with_data):
+    if with_data:
+        write_sample(tmp_path)
+    filename = tmp_path / "sample.bin.temp"
+    # old text format, block size and completed block list
+    filename.write_text("262144:0,1,2")
+    resume = download.FileResume(str(filename))
+    assert resume.size == 0
+    assert resume.blocks == []
+
+    # completed blocks past the end of the data file
+    resume.set_block_size(len(DATA))
+    resume.extend_blocks([0, 1])
+    resume.close()
+    resume = download.FileResume(str(filename))
+    assert resume.blocks == []
+
+
+def test_file_resume_update_block_size(tmp_path):
+    resume = download.FileResume(str(tmp_path / "sample.bin.temp"))
+    resume.set_block_size(100)
+    resume.extend_blocks([0, 1, 2, 3, 4, 7, 8])
+
+    resume.update_block_size(200)
+    assert resume.size == 200
+    assert resume.blocks == [0, 1]
+
+    resume.update_block_size(50)
+    assert resume.blocks == [0, 1, 2, 3, 4, 5, 6, 7]
+
+
+@pytest.mark.parametrize("old_size,new_size", [(3, 7), (7, 3), (16, 1), (1, 16)])
+def test_file_resume_update_block_size_runs(tmp_path, old_size, new_size):
+    blocks = [i for i in range(300) if i % 37 not in (5, 6) and i != 101]
+    resume = download.FileResume(str(tmp_path / "sample.bin.temp"))
+    resume.set_block_size(old_size)
+    resume.extend_blocks(blocks)
+
+    done = set()
+    for block_id in blocks:
+        done.update(range(block_id * old_size, (block_id + 1) * old_size))
+    expected = [
+        block_id
+        for block_id in range(300 * old_size // new_size + 1)
+        if done.issuperset(range(block_id * new_size, (block_id + 1) * new_size))
+    ]
+
+    resume.update_block_size(new_size)
+    assert resume.blocks == expected
+
+
+def test_file_resume_complete(tmp_path):
+    filename = tmp_path / "sample.bin.temp"
+    resume = download.FileResume(str(filename))
+    resume.add_block(3)
+    assert filename.stat().st_size == download.RESUME_HEADER.size + 1
+    resume.complete()
+    assert not filename.exists()
+
+
+def test_thread_safe_file_positioned_io(tmp_path):
+    fileobj = download.ThreadSafeFile(str(tmp_path / "sample.bin"), "wb+")
+    fileobj.write_at(b"world", 5)
+    fileobj.write_at(b"hello", 0)
+    assert fileobj.read_at(10, 0) == b"helloworld"
+    assert fileobj.read_at(10, 5) == b"world"
+    assert fileobj.tell() == 0
+    fileobj.close()
+
+
+def test_verify_chunk_checksum():
+    checksums = {"md5": "0" * 32, "sha1": hashlib.sha1(DATA).hexdigest().upper()}
+    # only the strongest checksum provided is checked
+    assert download.verify_chunk_checksum(DATA, checksums)
+    assert not download.verify_chunk_checksum(DATA[1:], checksums)
+    assert download.verify_chunk_checksum(DATA, {})
+
+
+def test_chunk_hasher():
+    checksums = {"md5": "0" * 32, "sha256": "AB" * 32}
+    hash_obj, expected = download.chunk_hasher(checksums)
+    assert hash_obj.name == "sha256"
+    assert expected == "ab" * 32
+    assert download.chunk_hasher({"sha1": ""}) == (None, None)
+    assert download.chunk_hasher() == (None, None)
+
+
+def test_filehash(tmp_path):
+    sample = write_sample(tmp_path)
+    assert download.filehash(sample, hashlib.sha1()) == hashlib.sha1(DATA).hexdigest()
+    assert download.filehash(str(tmp_path / "missing.bin"), hashlib.sha1()) == ""
+
+
+def test_get_gpg_reuses_keyring(tmp_path, monkeypatch):
+    imported = []
+
+    class FakeGPG:
+        def __init__(self, keyring=None):
+            pass
+
+        def import_key(self, key):
+            imported.append(key)
+
+    monkeypatch.setattr(download.GPG, "GPGSubprocess", FakeGPG)
+    monkeypatch.setattr(download, "PGP_KEY_DIR", str(tmp_path))
+    monkeypatch.setattr(download, "PGP_GPG", None)
+    (tmp_path / "one.asc").write_text("key one")
+
+    gpg = download.get_gpg()
+    assert download.get_gpg() is gpg
+    assert imported == ["key one"]
+
+    (tmp_path / "two.gpg").write_text("key two")
+    assert download.get_gpg() is not gpg
+    assert sorted(imported) == ["key one", "key one", "key two"]
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    """
+    /good/ serves DATA with ranges, /slow404/ answers 404 after a delay and
+    /short/ closes the connection halfway through the first range
+    """
+
+    protocol_version = "HTTP/1.1"
+    data = DATA[: 3 * 65536]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # segments send the absolute URL as the request path
+        if "/short/" in self.path:
+            # half of the range, then the connection closes
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes 0-65535/%d" % len(self.data))
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.wfile.write(self.data[:32768])
+            self.close_connection = True
+            return
+        if "/slow404/" in self.path:
+            time.sleep(0.5)
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start, end = 0, len(self.data) - 1
+        byte_range = self.headers.get("Range")
+        if byte_range is not None:
+            first, last = byte_range.split("=")[1].split("-")
+            start = int(first)
+            if last:
+                end = min(int(last), end)
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, end, len(self.data))
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(self.data[start : end + 1])
+
+    do_HEAD = do_GET
+
+
+@pytest.fixture
+def mirror_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_segment_manager_reassigns_failed_chunk(tmp_path, mirror_server):
+    data = MirrorHandler.data
+    fileobj = metalink.MetalinkFile("sample.bin")
+    fileobj.filename = str(tmp_path / "sample.bin")
+    fileobj.set_size(len(data))
+    fileobj.hashlist = {"sha256": hashlib.sha256(data).hexdigest()}
+    fileobj.piecelength = 65536
+    fileobj.add_url(mirror_server + "/good/sample.bin", preference="90")
+    fileobj.add_url(mirror_server + "/slow404/sample.bin", preference="100")
+
+    manager = download.Segment_Manager(fileobj)
+    result = []
+    # the mirror that finishes first must pick up the chunk the other one fails
+    thread = threading.Thread(target=lambda: result.append(manager.run()))
+    thread.daemon = True
+    thread.start()
+    thread.join(20)
+    if thread.is_alive():
+        manager.cancel_handler = lambda: True
+        thread.join(5)
+        pytest.fail("download did not finish")
+
+    assert result == [True]
+    assert (tmp_path / "sample.bin").read_bytes() == data
+
+
+def test_ftp_segment_fails_on_early_close(tmp_path, mirror_server, monkeypatch):
+    # the proxied FTP transfer reads the range from the mirror server
+    monkeypatch.setattr(download.proxy, "FTP_PROXY", mirror_server)
+    fileobj = download.ThreadSafeFile(str(tmp_path / "sample.bin"), "wb+")
+    host = download.Ftp_Host("ftp://127.0.0.1/short/sample.bin", fileobj)
+    segment = download.Ftp_Host_Segment(host, 0, 65536, len(MirrorHandler.data), {})
+    segment.start()
+    segment.join(10)
+    fileobj.close()
+
+    assert not segment.is_alive()
+    assert segment.error == "incomplete read"
+    assert segment.bytes == 32768
+
+
+def test_get_size_skips_unreachable_ftp(tmp_path, mirror_server):
+    fileobj = metalink.MetalinkFile("sample.bin")
+    fileobj.filename = str(tmp_path / "sample.bin")
+    fileobj.piecelength = 65536
+    # nothing listens on port 1, the connection is refused
+    fileobj.add_url("ftp://127.0.0.1:1/sample.bin", preference="100")
+    fileobj.add_url(mirror_server + "/good/sample.bin", preference="90")
+
+    manager = download.Segment_Manager(fileobj)
+    assert manager.head_size("ftp://127.0.0.1:1/sample.bin") == (None, {})
+    assert manager.get_size() == len(MirrorHandler.data)
+
+
+def test_stream_request_waits_for_data(tmp_path):
+    fileobj = download.ThreadSafeFile(str(tmp_path / "sample.bin"), "wb+")
+    fileobj.write_at(DATA[:100], 0)
+    reads = []
+    read_at = fileobj.read_at
+
+    def counting_read_at(size, offset):
+        reads.append(offset)
+        return read_at(size, offset)
+
+    fileobj.read_at = counting_read_at
+
+    server = download.StreamServer(("127.0.0.1", 0), download.StreamRequest)
+    server.set_stream(fileobj)
+    # more is advertised than has been written
+    server.set_length(1024)
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+    conn.request("GET", "/")
+    response = conn.getresponse()
+    assert response.read(100) == DATA[:100]
+    time.sleep(0.5)
+    server.stop()
+    conn.close()
+    thread.join(5)
+    fileobj.close()
+
+    # the handler polls a few times a second rather than spinning
+    assert len(reads) < 20